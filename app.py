@@ -1,7 +1,10 @@
 import streamlit as st
 import pandas as pd
 import os
-from database import ExcelDatabase
+import io
+import hashlib
+import tempfile
+from database import ExcelDatabase, iter_excel_sheets
 from llm_providers import LLMProvider
 from rag_system import RAGSystem
 
@@ -26,8 +29,13 @@ if 'sheets' not in st.session_state:
     st.session_state.sheets = None
 if 'uploaded_file' not in st.session_state:
     st.session_state.uploaded_file = None
+if 'rag' not in st.session_state:
+    st.session_state.rag = None
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
+# Providers keyed by (provider name, API key hash) so their HTTP clients are reused
+if 'provider_cache' not in st.session_state:
+    st.session_state.provider_cache = {}
 # API key states
 if 'openai_api_key' not in st.session_state:
     st.session_state.openai_api_key = ""
@@ -36,23 +44,82 @@ if 'gemini_api_key' not in st.session_state:
 if 'openrouter_api_key' not in st.session_state:
     st.session_state.openrouter_api_key = ""
 
+# Workbooks at least this large are parsed with one process per sheet
+PARALLEL_PARSE_MIN_BYTES = 5 * 1024 * 1024
+
+# Provider labels; chat history stores an index into this list
+PROVIDER_OPTIONS = ["OpenAI (GPT-4o)", "Google (Gemini 2.0 Flash)", "DeepSeek (via OpenRouter)"]
+
+# Number of most recent exchanges always shown; older ones render on request
+RECENT_HISTORY_SIZE = 10
+
+def render_exchange(number, exchange):
+    """
+    Render a single question and answer from the chat history.
+    
+    Args:
+        number (int): Position of the question in the history, starting at 1
+        exchange (dict): Chat history entry
+    """
+    with st.container():
+        st.markdown(f"#### Question {number}")
+        st.markdown(f"**Q:** {exchange['question']}")
+        st.markdown(f"**Using:** {PROVIDER_OPTIONS[exchange['provider']]}")
+        
+        # with st.expander("View SQL Query"):
+        #     st.code(exchange['sql'], language="sql")
+        
+        st.markdown(f"**Answer:** {exchange['answer']}")
+        st.markdown("---")
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_excel(content_bytes):
+    """
+    Parse all sheets of an Excel file, memoized on the file contents.
+    
+    Args:
+        content_bytes (bytes): Raw contents of the uploaded file
+        
+    Returns:
+        dict: Mapping of sheet name to pandas.DataFrame
+    """
+    if len(content_bytes) < PARALLEL_PARSE_MIN_BYTES:
+        return dict(iter_excel_sheets(io.BytesIO(content_bytes)))
+    
+    # Worker processes can't receive the upload itself, so spill it to a file they can open
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file.write(content_bytes)
+    try:
+        return dict(iter_excel_sheets(temp_file.name, max_workers=os.cpu_count() or 1))
+    finally:
+        os.remove(temp_file.name)
+
 # File uploader
 uploaded_file = st.file_uploader("Upload an Excel file", type=['xlsx', 'xls'])
 
+# Identify uploads by content so re-uploading the same workbook is not re-parsed
+uploaded_digest = None
+if uploaded_file:
+    content = uploaded_file.getvalue()
+    uploaded_digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+
 # Process the uploaded file
-if uploaded_file and (st.session_state.uploaded_file != uploaded_file.name):
+if uploaded_file and (st.session_state.uploaded_file != uploaded_digest):
     try:
-        st.session_state.uploaded_file = uploaded_file.name
+        st.session_state.uploaded_file = uploaded_digest
         
-        # Read all sheets from Excel file
+        # Read all sheets from the Excel file (cached for recently seen files)
         with st.spinner('Loading Excel file...'):
-            st.session_state.sheets = pd.read_excel(uploaded_file, sheet_name=None)
+            st.session_state.sheets = load_excel(content)
             
             # Create the database
             st.session_state.db = ExcelDatabase()
             for sheet_name, df in st.session_state.sheets.items():
                 st.session_state.db.add_sheet(sheet_name, df)
             
+            # Create the RAG system now so the schema is built while the user types
+            st.session_state.rag = RAGSystem(st.session_state.db)
+            
             st.success(f"Successfully loaded {len(st.session_state.sheets)} sheets from {uploaded_file.name}")
             
             # Reset chat history when a new file is uploaded
@@ -62,6 +129,7 @@ if uploaded_file and (st.session_state.uploaded_file != uploaded_file.name):
         st.error(f"Error loading Excel file: {str(e)}")
         st.session_state.db = None
         st.session_state.sheets = None
+        st.session_state.rag = None
 
 # Display available sheets if file is uploaded
 if st.session_state.sheets is not None:
@@ -85,7 +153,7 @@ if st.session_state.sheets is not None:
     st.subheader("Select LLM Provider")
     llm_provider = st.selectbox(
         "Choose the AI model to use for answering your questions:",
-        ["OpenAI (GPT-4o)", "Google (Gemini 2.0 Flash)", "DeepSeek (via OpenRouter)"]
+        PROVIDER_OPTIONS
     )
     
     # API key input based on selected provider
@@ -128,24 +196,41 @@ if st.session_state.sheets is not None:
                         
                     # Initialize the appropriate LLM provider with API key
                     if "OpenAI" in llm_provider:
-                        provider = LLMProvider.create("openai", api_key)
+                        provider_name = "openai"
                     elif "Google" in llm_provider:
-                        provider = LLMProvider.create("gemini", api_key)
+                        provider_name = "gemini"
                     else:  # DeepSeek
-                        provider = LLMProvider.create("openrouter", api_key)
+                        provider_name = "openrouter"
                     
-                    # Initialize the RAG system
-                    rag = RAGSystem(st.session_state.db, provider)
+                    # Reuse the provider (and its open connections) from earlier questions
+                    provider_key = (provider_name, hashlib.sha256(api_key.encode()).hexdigest())
+                    provider = st.session_state.provider_cache.get(provider_key)
+                    if provider is None:
+                        provider = LLMProvider.create(provider_name, api_key)
+                        st.session_state.provider_cache[provider_key] = provider
+                    
+                    # Reuse the RAG system created on upload so its answer cache survives reruns
+                    rag = st.session_state.rag
+                    rag.llm_provider = provider
+                    
+                    # Show the answer as it is generated, then clear it once it joins the history
+                    answer_placeholder = st.empty()
+                    streamed_chunks = []
+                    
+                    def show_partial_answer(text):
+                        streamed_chunks.append(text)
+                        answer_placeholder.markdown("".join(streamed_chunks))
                     
                     # Get response
-                    sql_query, response = rag.query(user_query)
+                    sql_query, response = rag.query(user_query, stream_to=show_partial_answer)
+                    answer_placeholder.empty()
                     
                     # Add to chat history
                     st.session_state.chat_history.append({
                         "question": user_query,
                         "sql": sql_query,
                         "answer": response,
-                        "provider": llm_provider
+                        "provider": PROVIDER_OPTIONS.index(llm_provider)
                     })
                     
             except Exception as e:
@@ -155,17 +240,16 @@ if st.session_state.sheets is not None:
     if st.session_state.chat_history:
         st.subheader("Question & Answer History")
         total_questions = len(st.session_state.chat_history)
-        for i, exchange in enumerate(reversed(st.session_state.chat_history)):
-            with st.container():
-                st.markdown(f"#### Question {total_questions - i}")
-                st.markdown(f"**Q:** {exchange['question']}")
-                st.markdown(f"**Using:** {exchange['provider']}")
-                
-                # with st.expander("View SQL Query"):
-                #     st.code(exchange['sql'], language="sql")
-                
-                st.markdown(f"**Answer:** {exchange['answer']}")
-                st.markdown("---")
+        recent_history = st.session_state.chat_history[-RECENT_HISTORY_SIZE:]
+        for i, exchange in enumerate(reversed(recent_history)):
+            render_exchange(total_questions - i, exchange)
+        
+        # Older exchanges are only rendered when asked for, keeping reruns fast in long sessions
+        older_count = total_questions - len(recent_history)
+        if older_count and st.toggle(f"Show older history ({older_count})"):
+            older_history = st.session_state.chat_history[:older_count]
+            for i, exchange in enumerate(reversed(older_history)):
+                render_exchange(older_count - i, exchange)
 else:
     st.info("Please upload an Excel file to begin.")
 
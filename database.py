@@ -1,6 +1,76 @@
+import contextlib
+import hashlib
+import multiprocessing
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import sqlite3
 
+from json_utils import to_json
+
+try:
+    # The Rust-backed calamine reader is much faster than openpyxl
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    # Let pandas pick its default engine (openpyxl for .xlsx)
+    EXCEL_ENGINE = None
+
+# Maximum number of query results kept in the SQL result cache
+QUERY_CACHE_SIZE = 128
+
+# Characters that aren't valid in an unquoted SQLite identifier
+_CLEAN_PATTERN = re.compile(r'[^a-zA-Z0-9]')
+
+# Map numpy dtype kinds to more understandable types; anything else is TEXT
+DTYPE_MAP = {'i': 'INTEGER', 'u': 'INTEGER', 'f': 'REAL', 'M': 'DATETIME'}
+
+def iter_excel_sheets(source, max_workers=1):
+    """
+    Read an Excel file one sheet at a time.
+    
+    Args:
+        source (str or file-like): Path or file object of the Excel file
+        max_workers (int): Number of processes used to parse sheets in parallel.
+            Values above 1 require source to be a path, since each worker opens
+            the workbook itself.
+        
+    Yields:
+        tuple: (sheet_name, pandas.DataFrame) for each sheet in the workbook
+    """
+    with pd.ExcelFile(source, engine=EXCEL_ENGINE) as excel_file:
+        sheet_names = excel_file.sheet_names
+        if max_workers <= 1 or len(sheet_names) < 2:
+            for sheet_name in sheet_names:
+                yield sheet_name, excel_file.parse(sheet_name)
+            return
+    
+    # Spawn rather than fork, since the Streamlit server process is multithreaded
+    with ProcessPoolExecutor(
+        max_workers=min(max_workers, len(sheet_names)),
+        mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        frames = executor.map(_read_sheet, [source] * len(sheet_names), sheet_names)
+        yield from zip(sheet_names, frames)
+
+
+def _read_sheet(path, sheet_name):
+    """
+    Read a single sheet of an Excel file; runs in a worker process.
+    
+    Args:
+        path (str): Path of the Excel file
+        sheet_name (str): Name of the sheet to read
+        
+    Returns:
+        pandas.DataFrame: Contents of the sheet
+    """
+    return pd.read_excel(path, sheet_name=sheet_name, engine=EXCEL_ENGINE)
+
+
 class ExcelDatabase:
     """
     A class to handle Excel database operations.
@@ -10,7 +80,21 @@ class ExcelDatabase:
     def __init__(self):
         """Initialize the in-memory SQLite database."""
         self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        # The database is rebuilt from the Excel file, so durability isn't needed
+        self.conn.executescript(
+            "PRAGMA journal_mode=MEMORY; PRAGMA synchronous=OFF; PRAGMA temp_store=MEMORY;"
+        )
+        # Generated SQL only ever needs to read the data; add_sheet lifts this while writing
+        self.conn.execute("PRAGMA query_only=ON")
         self.sheets = {}
+        # Schema derived from the loaded sheets, rebuilt lazily after add_sheet
+        self._schema_cache = None
+        self._schema_json = None
+        self._schema_hash = None
+        # Results of previously executed queries, keyed by stripped SQL
+        self._query_cache = OrderedDict()
+        # Serializes queries, writes and cache updates when several threads share the database
+        self._lock = threading.Lock()
         
     def add_sheet(self, sheet_name, df):
         """
@@ -27,23 +111,139 @@ class ExcelDatabase:
         self.sheets[sheet_name] = {
             'clean_name': clean_name,
             'columns': list(df.columns),
-            'data': df
+            'data': df,
+            'sample_values': self._sample_values(sheet_name, df)
         }
         
-        # Write the DataFrame to the SQLite database
-        df.to_sql(clean_name, self.conn, index=False, if_exists='replace')
+        with self._lock, self._writable():
+            # Write the DataFrame to the SQLite database in a single transaction,
+            # inserting rows in executemany batches
+            with self.conn:
+                df.to_sql(clean_name, self.conn, index=False, if_exists='replace', chunksize=1000)
+            
+            # Index likely filter/group keys, then collect statistics for the planner
+            self._create_indexes(clean_name, df)
+            self.conn.execute(f'ANALYZE "{clean_name}"')
+            
+            # The data changed, so the cached schema is stale
+            self._schema_cache = None
+            self._schema_json = None
+            self._schema_hash = None
+            self._query_cache.clear()
+    
+    @contextlib.contextmanager
+    def _writable(self):
+        """Temporarily allow writes on the otherwise read-only connection."""
+        self.conn.execute("PRAGMA query_only=OFF")
+        try:
+            yield
+        finally:
+            self.conn.execute("PRAGMA query_only=ON")
+    
+    def _sample_values(self, sheet_name, df, count=3):
+        """
+        Pick representative sample values for each column of a sheet.
+        
+        Values are drawn at random from the whole column rather than taken from
+        the first rows, but seeded from the sheet name so the same sheet always
+        yields the same samples (and therefore the same schema fingerprint).
+        
+        Args:
+            sheet_name (str): Name of the sheet
+            df (pandas.DataFrame): Data of the sheet
+            count (int): Number of values to sample per column
+            
+        Returns:
+            list: Sample values for each column, in column order
+        """
+        # crc32 rather than hash(), which is salted per process
+        seed = zlib.crc32(str(sheet_name).encode())
+        samples = []
+        for position in range(df.shape[1]):
+            values = df.iloc[:, position].dropna()
+            sample = values.sample(n=min(count, len(values)), random_state=seed)
+            # Keep the samples in sheet order
+            samples.append(sample.sort_index().tolist())
+        return samples
+    
+    def _create_indexes(self, clean_name, df):
+        """
+        Index the columns of a table that queries are likely to filter or group on.
+        
+        Datetime columns are always indexed. Other non-float columns are indexed
+        when their cardinality is low relative to the number of rows.
+        
+        Args:
+            clean_name (str): Cleaned table name
+            df (pandas.DataFrame): DataFrame the table was created from
+        """
+        nunique = df.nunique(dropna=True)
+        max_unique = max(32, len(df) // 2)
+        
+        with self.conn:
+            for position, (col, dtype) in enumerate(zip(df.columns, df.dtypes)):
+                if dtype.kind != 'M' and (dtype.kind == 'f' or nunique.iloc[position] >= max_unique):
+                    continue
+                
+                # Name by position; cleaned column names can collide across tables
+                index_name = f"idx_{clean_name}_{position}"
+                quoted_col = '"' + str(col).replace('"', '""') + '"'
+                self.conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{clean_name}"({quoted_col})'
+                )
     
-    def execute_query(self, query):
+    def execute_query(self, query, max_rows=None):
         """
         Execute an SQL query on the SQLite database.
         
         Args:
             query (str): SQL query to execute
+            max_rows (int, optional): Maximum number of rows to load into the
+                DataFrame. Remaining rows are only counted, and the full row count
+                is stored in the result's attrs['total_rows'].
             
         Returns:
             pandas.DataFrame: Result of the query
         """
-        return pd.read_sql_query(query, self.conn)
+        # Only surrounding whitespace is ignored; case and spacing inside
+        # string literals change the result
+        key = (query.strip(), max_rows)
+        with self._lock:
+            if key in self._query_cache:
+                self._query_cache.move_to_end(key)
+                # Hand out a copy so callers can't mutate the cached result
+                return self._query_cache[key].copy()
+            
+            if max_rows is None:
+                result = pd.read_sql_query(query, self.conn)
+            else:
+                result = self._read_limited(query, max_rows)
+            
+            self._query_cache[key] = result
+            if len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+            return result.copy()
+    
+    def _read_limited(self, query, max_rows):
+        """
+        Run a query, materializing at most max_rows rows as a DataFrame.
+        
+        Args:
+            query (str): SQL query to execute
+            max_rows (int): Maximum number of rows to load
+            
+        Returns:
+            pandas.DataFrame: The first max_rows rows of the result
+        """
+        cursor = self.conn.execute(query)
+        columns = [column[0] for column in cursor.description or []]
+        rows = cursor.fetchmany(max_rows)
+        # Count the rest without keeping it around
+        total_rows = len(rows) + sum(1 for _ in cursor)
+        
+        result = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        result.attrs['total_rows'] = total_rows
+        return result
     
     def get_all_sheet_info(self):
         """
@@ -54,6 +254,76 @@ class ExcelDatabase:
         """
         return self.sheets
     
+    def get_schema(self):
+        """
+        Get schema information about all tables in the database.
+        
+        The schema is built once and cached until the next call to add_sheet.
+        
+        Returns:
+            dict: Schema information about all tables in the database
+        """
+        if self._schema_cache is None:
+            schema = self._build_schema()
+            self._schema_json = to_json(schema)
+            self._schema_hash = hashlib.blake2b(self._schema_json.encode()).hexdigest()
+            # Publish the schema last so concurrent readers never see a partial cache
+            self._schema_cache = schema
+        return self._schema_cache
+    
+    def get_schema_json(self):
+        """
+        Get the schema serialized as JSON, ready to be embedded in a prompt.
+        
+        Returns:
+            str: JSON representation of the database schema
+        """
+        self.get_schema()
+        return self._schema_json
+    
+    def get_schema_fingerprint(self):
+        """
+        Get a hash identifying the current schema and sample data.
+        
+        Returns:
+            str: Hex digest that changes whenever a sheet is added
+        """
+        self.get_schema()
+        return self._schema_hash
+    
+    def _build_schema(self):
+        """
+        Build the schema information from the loaded sheets.
+        
+        Returns:
+            dict: Schema information about all tables in the database
+        """
+        schema = {}
+        
+        for sheet_name, info in self.sheets.items():
+            df = info['data']
+            
+            # Get column information
+            column_types = [DTYPE_MAP.get(dtype.kind, 'TEXT') for dtype in df.dtypes]
+            columns = [
+                {
+                    'name': col,
+                    'type': column_type,
+                    'sample_values': sample_values
+                }
+                for col, column_type, sample_values in zip(
+                    df.columns, column_types, info['sample_values']
+                )
+            ]
+            
+            schema[sheet_name] = {
+                'table_name': info['clean_name'],
+                'columns': columns,
+                'row_count': len(df)
+            }
+        
+        return schema
+    
     def get_table_schema(self, table_name):
         """
         Get the schema for a specific table.
@@ -80,8 +350,7 @@ class ExcelDatabase:
             str: Cleaned table name
         """
         # Replace spaces and special characters with underscores
-        import re
-        clean = re.sub(r'[^a-zA-Z0-9]', '_', name)
+        clean = _CLEAN_PATTERN.sub('_', name)
         
         # Ensure it doesn't start with a number
         if clean[0].isdigit():
@@ -0,0 +1,22 @@
+import json
+
+try:
+    # orjson serializes large objects such as the schema several times faster than json
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def to_json(obj):
+    """
+    Serialize an object as indented JSON, using orjson when it is installed.
+    
+    Args:
+        obj: Object to serialize; unsupported values are converted with str()
+        
+    Returns:
+        str: JSON representation of the object
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2, default=str).decode()
+    return json.dumps(obj, indent=2, default=str)
@@ -2,14 +2,117 @@ import os
 import json
 import requests
 from abc import ABC, abstractmethod
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from openai import OpenAI
 import google.generativeai as genai
 
+from json_utils import to_json
+
+
+def _schema_to_str(database_schema):
+    """
+    Get the prompt representation of a database schema.
+    
+    Args:
+        database_schema (dict or str): Schema information, or its JSON serialization
+        
+    Returns:
+        str: JSON representation of the schema
+    """
+    # The database caches the serialized schema, so reuse it when given
+    if isinstance(database_schema, str):
+        return database_schema
+    return to_json(database_schema)
+
+
+def _context_to_prompt(context):
+    """
+    Get the prompt representation of a response context.
+    
+    The schema is appended as-is rather than being serialized again as part
+    of the context, so an already serialized schema is reused.
+    
+    Args:
+        context (dict): Context information, optionally including a 'schema'
+        
+    Returns:
+        str: String representation of the context
+    """
+    details = {key: value for key, value in context.items() if key != 'schema'}
+    context_str = to_json(details)
+    if context.get('schema') is not None:
+        context_str += f"\n\nDATABASE SCHEMA:\n{_schema_to_str(context['schema'])}"
+    return context_str
+
+
+def _result_to_prompt(sql_result, max_rows=50, max_chars=4000):
+    """
+    Get a compact prompt representation of a SQL result.
+    
+    Rows are rendered as CSV, which avoids the column padding of to_string().
+    A total row count in sql_result.attrs['total_rows'] takes precedence over
+    len(sql_result) for results the database truncated.
+    Results that are still too long are replaced by summary statistics plus a
+    few sample rows.
+    
+    Args:
+        sql_result (pandas.DataFrame): Result of the SQL query
+        max_rows (int): Maximum number of rows to include
+        max_chars (int): Maximum length of the rendered rows
+        
+    Returns:
+        str: String representation of the result
+    """
+    if sql_result is None or sql_result.empty:
+        return "No results found"
+    
+    # The database may have loaded only the first rows of a large result
+    total_rows = sql_result.attrs.get('total_rows', len(sql_result))
+    result_str = sql_result.head(max_rows).to_csv(index=False)
+    
+    if len(result_str) > max_chars:
+        summary = sql_result.describe(include='all').to_csv()
+        sample = sql_result.head(5).to_csv(index=False)
+        if total_rows > len(sql_result):
+            heading = f"Summary of the first {len(sql_result)} of {total_rows} rows"
+        else:
+            heading = f"Summary of all {total_rows} rows"
+        result_str = f"{heading}:\n{summary}\nSample rows:\n{sample}"
+        return result_str[:max_chars]
+    
+    if total_rows > max_rows:
+        result_str += f"(showing the first {min(max_rows, len(sql_result))} of {total_rows} rows)\n"
+    return result_str
+
+
+def _collect_stream(text_chunks, stream_to):
+    """
+    Forward streamed text chunks to a callback and collect the full text.
+    
+    Args:
+        text_chunks (iterable): Pieces of generated text, possibly empty or None
+        stream_to (callable): Called with each non-empty piece as it arrives
+        
+    Returns:
+        str: The complete generated text
+    """
+    parts = []
+    for text in text_chunks:
+        if text:
+            parts.append(text)
+            stream_to(text)
+    return "".join(parts).strip()
+
+
 class LLMProvider(ABC):
     """
     Abstract base class for LLM providers.
     """
     
+    # Providers that can run SQL through tool calls override answer_with_tools
+    supports_tools = False
+    
     @staticmethod
     def create(provider_name, api_key=None):
         """
@@ -38,7 +141,8 @@ class LLMProvider(ABC):
         
         Args:
             query (str): Natural language query
-            database_schema (dict): Schema information about the database
+            database_schema (dict or str): Schema information about the database,
+                or its JSON serialization
             
         Returns:
             str: SQL query
@@ -46,19 +150,77 @@ class LLMProvider(ABC):
         pass
     
     @abstractmethod
-    def generate_response(self, query, sql_result, context):
+    def generate_response(self, query, sql_result, context, stream_to=None):
         """
         Generate a natural language response from SQL results.
         
         Args:
             query (str): Original natural language query
             sql_result (pandas.DataFrame): Result of the SQL query
-            context (dict): Additional context information
+            context (dict): Additional context information; its 'schema' entry may
+                be the schema dict or its JSON serialization
+            stream_to (callable, optional): If given, the response is streamed and
+                this is called with each chunk of text as it is generated
             
         Returns:
             str: Natural language response
         """
         pass
+    
+    def answer_with_tools(self, query, database_schema, run_sql, stream_to=None):
+        """
+        Answer a query in a single conversation where the model calls a SQL tool.
+        
+        Args:
+            query (str): Natural language query
+            database_schema (dict or str): Schema information about the database,
+                or its JSON serialization
+            run_sql (callable): Executes a SQL query and returns a pandas.DataFrame,
+                raising an exception if the query is invalid
+            stream_to (callable, optional): If given, the final answer is streamed and
+                this is called with each chunk of text as it is generated
+            
+        Returns:
+            str: Natural language response
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support tool calls")
+    
+    def generate_sql_batch(self, queries, database_schema):
+        """
+        Generate SQL for several natural language queries.
+        
+        Providers that can answer several questions in one prompt override this;
+        the default makes one generate_sql call per query.
+        
+        Args:
+            queries (list): Natural language queries
+            database_schema (dict or str): Schema information about the database,
+                or its JSON serialization
+            
+        Returns:
+            list: SQL query for each natural language query, in order
+        """
+        return [self.generate_sql(query, database_schema) for query in queries]
+    
+    def generate_response_batch(self, queries, sql_results, contexts):
+        """
+        Generate natural language responses for several queries and their results.
+        
+        Providers that can answer several questions in one prompt override this;
+        the default makes one generate_response call per query.
+        
+        Args:
+            queries (list): Original natural language queries
+            sql_results (list): pandas.DataFrame result for each query
+            contexts (list): Context dict for each query
+            
+        Returns:
+            list: Natural language response for each query, in order
+        """
+        return [
+            self.generate_response(query, sql_result, context)
+            for query, sql_result, context in zip(queries, sql_results, contexts)
+        ]
 
 
 class OpenAIProvider(LLMProvider):
@@ -66,6 +228,28 @@ class OpenAIProvider(LLMProvider):
     OpenAI implementation of the LLM provider.
     """
     
+    supports_tools = True
+    # Upper bound on model turns when answering through the SQL tool
+    max_tool_rounds = 3
+    
+    SQL_TOOL = {
+        "type": "function",
+        "function": {
+            "name": "run_sql",
+            "description": "Run a SQLite query against the user's Excel data and return the result rows.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "A single valid SQLite SELECT query."
+                    }
+                },
+                "required": ["query"]
+            }
+        }
+    }
+    
     def __init__(self, api_key=None):
         """Initialize the OpenAI provider with API key."""
         # First check if API key is passed directly, then check environment
@@ -82,7 +266,7 @@ class OpenAIProvider(LLMProvider):
     
     def generate_sql(self, query, database_schema):
         """Generate SQL from natural language using OpenAI."""
-        schema_str = json.dumps(database_schema, indent=2)
+        schema_str = _schema_to_str(database_schema)
         
         prompt = f"""
         You are an expert in translating natural language questions to SQL queries.
@@ -108,13 +292,11 @@ class OpenAIProvider(LLMProvider):
         
         return response.choices[0].message.content.strip()
     
-    def generate_response(self, query, sql_result, context):
+    def generate_response(self, query, sql_result, context, stream_to=None):
         """Generate natural language response from SQL results using OpenAI."""
-        # Convert the SQL result to a string representation
-        if sql_result is not None and not sql_result.empty:
-            result_str = sql_result.to_string()
-        else:
-            result_str = "No results found"
+        # Convert the SQL result to a compact string representation
+        result_str = _result_to_prompt(sql_result)
+        context_str = _context_to_prompt(context)
         
         prompt = f"""
         You are an expert data analyst providing answers based on SQL query results.
@@ -126,23 +308,201 @@ class OpenAIProvider(LLMProvider):
         {result_str}
         
         CONTEXT:
-        {json.dumps(context, indent=2)}
+        {context_str}
         
         Your task is to provide a clear, concise answer to the user's question based on the SQL query results.
         Explain the results in natural language, providing insights and context where appropriate.
         If the results are empty or don't directly answer the question, acknowledge this and explain possible reasons why.
         """
         
+        return self._complete(
+            stream_to,
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "You are a data analysis expert explaining query results in natural language."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.3
+        )
+    
+    def answer_with_tools(self, query, database_schema, run_sql, stream_to=None):
+        """Answer a query with OpenAI, letting the model run SQL through a tool call."""
+        schema_str = _schema_to_str(database_schema)
+        
+        prompt = f"""
+        You are an expert data analyst answering questions about Excel data stored in SQLite.
+        
+        DATABASE SCHEMA:
+        {schema_str}
+        
+        USER QUESTION:
+        {query}
+        
+        Call the run_sql tool with a valid SQL query that retrieves the data needed to answer the question, using the correct table and column names.
+        Then provide a clear, concise answer to the user's question based on the SQL query results.
+        Explain the results in natural language, providing insights and context where appropriate.
+        If the results are empty or don't directly answer the question, acknowledge this and explain possible reasons why.
+        """
+        
+        messages = [
+            {"role": "system", "content": "You are a data analysis expert who queries data with SQL and explains the results in natural language."},
+            {"role": "user", "content": prompt}
+        ]
+        
+        # Every round but the last may call the tool; the last must answer
+        for _ in range(self.max_tool_rounds - 1):
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                tools=[self.SQL_TOOL],
+                tool_choice="auto",
+                temperature=0
+            )
+            message = response.choices[0].message
+            
+            if not message.tool_calls:
+                # The model answered without needing any data
+                answer = message.content.strip()
+                if stream_to is not None:
+                    stream_to(answer)
+                return answer
+            
+            messages.append(message)
+            has_results = False
+            for tool_call in message.tool_calls:
+                try:
+                    sql_query = json.loads(tool_call.function.arguments).get("query", "")
+                    sql_result = run_sql(sql_query)
+                except Exception as e:
+                    # Report the error (including malformed tool arguments) so the
+                    # model can correct the query in the next round
+                    result_str = f"Error: {e}"
+                else:
+                    has_results = True
+                    result_str = _result_to_prompt(sql_result)
+                
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": tool_call.id,
+                    "content": result_str
+                })
+            
+            if has_results:
+                break
+        
+        # Once the data is in (or we're out of rounds), force a final text answer;
+        # no tool calls are possible here, so the answer can be streamed
+        return self._complete(
+            stream_to,
+            model=self.model,
+            messages=messages,
+            tools=[self.SQL_TOOL],
+            tool_choice="none",
+            temperature=0.3
+        )
+    
+    def generate_sql_batch(self, queries, database_schema):
+        """Generate SQL for several natural language queries in one OpenAI call."""
+        schema_str = _schema_to_str(database_schema)
+        questions_str = "\n".join(f"{number}. {query}" for number, query in enumerate(queries, 1))
+        
+        prompt = f"""
+        You are an expert in translating natural language questions to SQL queries.
+        
+        DATABASE SCHEMA:
+        {schema_str}
+        
+        USER QUESTIONS:
+        {questions_str}
+        
+        Your task is to generate a valid SQL query for each of the user's questions based on the provided database schema.
+        Respond with a JSON object of the form {{"queries": ["<SQL for question 1>", "<SQL for question 2>", ...]}} containing exactly {len(queries)} SQL queries in the same order as the questions.
+        Make sure each SQL query is valid and uses the correct table and column names.
+        """
+        
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "You are a SQL expert that translates natural language to SQL."},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={"type": "json_object"},
+            temperature=0
+        )
+        
+        return self._parse_batch(response.choices[0].message.content, "queries", len(queries))
+    
+    def generate_response_batch(self, queries, sql_results, contexts):
+        """Generate natural language responses for several queries in one OpenAI call."""
+        sections = []
+        for number, (query, sql_result, context) in enumerate(zip(queries, sql_results, contexts), 1):
+            sections.append(
+                f"QUESTION {number}:\n{query}\n\n"
+                f"SQL QUERY:\n{context.get('sql_query')}\n\n"
+                f"SQL QUERY RESULTS:\n{_result_to_prompt(sql_result)}"
+            )
+        questions_str = "\n\n".join(sections)
+        
+        prompt = f"""
+        You are an expert data analyst providing answers based on SQL query results.
+        
+        {questions_str}
+        
+        Your task is to provide a clear, concise answer to each of the user's questions based on its SQL query results.
+        Explain the results in natural language, providing insights and context where appropriate.
+        If the results are empty or don't directly answer a question, acknowledge this and explain possible reasons why.
+        Respond with a JSON object of the form {{"answers": ["<answer to question 1>", "<answer to question 2>", ...]}} containing exactly {len(queries)} answers in the same order as the questions.
+        """
+        
         response = self.client.chat.completions.create(
             model=self.model,
             messages=[
                 {"role": "system", "content": "You are a data analysis expert explaining query results in natural language."},
                 {"role": "user", "content": prompt}
             ],
+            response_format={"type": "json_object"},
             temperature=0.3
         )
         
-        return response.choices[0].message.content.strip()
+        return self._parse_batch(response.choices[0].message.content, "answers", len(queries))
+    
+    def _parse_batch(self, content, key, expected_count):
+        """
+        Extract the list of per-question outputs from a batched JSON response.
+        
+        Args:
+            content (str): JSON object returned by the model
+            key (str): Key holding the list of outputs
+            expected_count (int): Number of questions in the batch
+            
+        Returns:
+            list: Stripped output for each question, in order
+        """
+        items = json.loads(content).get(key)
+        if not isinstance(items, list) or len(items) != expected_count:
+            raise ValueError(f"Expected {expected_count} {key} from OpenAI, got: {content}")
+        return [str(item).strip() for item in items]
+    
+    def _complete(self, stream_to, **kwargs):
+        """
+        Run a chat completion, streaming it when a callback is given.
+        
+        Args:
+            stream_to (callable or None): Called with each chunk of streamed text
+            **kwargs: Arguments for chat.completions.create
+            
+        Returns:
+            str: The generated message content
+        """
+        if stream_to is None:
+            response = self.client.chat.completions.create(**kwargs)
+            return response.choices[0].message.content.strip()
+        
+        stream = self.client.chat.completions.create(stream=True, **kwargs)
+        return _collect_stream(
+            (chunk.choices[0].delta.content for chunk in stream if chunk.choices),
+            stream_to
+        )
 
 
 class GeminiProvider(LLMProvider):
@@ -161,10 +521,11 @@ class GeminiProvider(LLMProvider):
             
         # Store API key for later use with each request
         self.api_key = api_key
+        self.model = "gemini-2.0-flash"
     
     def generate_sql(self, query, database_schema):
         """Generate SQL from natural language using Gemini."""
-        schema_str = json.dumps(database_schema, indent=2)
+        schema_str = _schema_to_str(database_schema)
         
         prompt = f"""
         You are an expert in translating natural language questions to SQL queries.
@@ -181,20 +542,18 @@ class GeminiProvider(LLMProvider):
         
         # Configure the generative model
         genai.configure(api_key=self.api_key)
-        model = genai.GenerativeModel('gemini-2.0-flash')
+        model = genai.GenerativeModel(self.model)
         
         # Generate the SQL
         response = model.generate_content(prompt)
         
         return response.text.strip()
     
-    def generate_response(self, query, sql_result, context):
+    def generate_response(self, query, sql_result, context, stream_to=None):
         """Generate natural language response from SQL results using Gemini."""
-        # Convert the SQL result to a string representation
-        if sql_result is not None and not sql_result.empty:
-            result_str = sql_result.to_string()
-        else:
-            result_str = "No results found"
+        # Convert the SQL result to a compact string representation
+        result_str = _result_to_prompt(sql_result)
+        context_str = _context_to_prompt(context)
         
         prompt = f"""
         You are an expert data analyst providing answers based on SQL query results.
@@ -206,7 +565,7 @@ class GeminiProvider(LLMProvider):
         {result_str}
         
         CONTEXT:
-        {json.dumps(context, indent=2)}
+        {context_str}
         
         Your task is to provide a clear, concise answer to the user's question based on the SQL query results.
         Explain the results in natural language, providing insights and context where appropriate.
@@ -215,12 +574,15 @@ class GeminiProvider(LLMProvider):
         
         # Configure the generative model
         genai.configure(api_key=self.api_key)
-        model = genai.GenerativeModel('gemini-2.0-flash')
+        model = genai.GenerativeModel(self.model)
         
-        # Generate the response
-        response = model.generate_content(prompt)
+        # Generate the response, streaming it if requested
+        if stream_to is None:
+            response = model.generate_content(prompt)
+            return response.text.strip()
         
-        return response.text.strip()
+        response = model.generate_content(prompt, stream=True)
+        return _collect_stream((chunk.text for chunk in response), stream_to)
 
 
 class OpenRouterProvider(LLMProvider):
@@ -240,10 +602,26 @@ class OpenRouterProvider(LLMProvider):
         self.api_key = api_key
         self.api_url = "https://openrouter.ai/api/v1/chat/completions"
         self.model = "deepseek/deepseek-r1-zero:free"  # Updated to latest model
+        
+        # Keep one session so TCP/TLS connections are reused between calls
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        })
+        # Retry rate limits and transient gateway errors; POST must be allowed explicitly
+        retry = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False
+        )
+        self.session.mount("https://", HTTPAdapter(max_retries=retry))
     
     def generate_sql(self, query, database_schema):
         """Generate SQL from natural language using DeepSeek via OpenRouter."""
-        schema_str = json.dumps(database_schema, indent=2)
+        schema_str = _schema_to_str(database_schema)
         
         prompt = f"""
         You are an expert in translating natural language questions to SQL queries.
@@ -258,11 +636,6 @@ class OpenRouterProvider(LLMProvider):
         Return ONLY the SQL query without any explanations or comments. Make sure the SQL query is valid and uses the correct table and column names.
         """
         
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
         data = {
             "model": self.model,
             "messages": [
@@ -272,19 +645,17 @@ class OpenRouterProvider(LLMProvider):
             "temperature": 0
         }
         
-        response = requests.post(self.api_url, headers=headers, json=data)
+        response = self.session.post(self.api_url, json=data, timeout=60)
         response.raise_for_status()
         result = response.json()
         
         return result["choices"][0]["message"]["content"].strip()
     
-    def generate_response(self, query, sql_result, context):
+    def generate_response(self, query, sql_result, context, stream_to=None):
         """Generate natural language response from SQL results using DeepSeek via OpenRouter."""
-        # Convert the SQL result to a string representation
-        if sql_result is not None and not sql_result.empty:
-            result_str = sql_result.to_string()
-        else:
-            result_str = "No results found"
+        # Convert the SQL result to a compact string representation
+        result_str = _result_to_prompt(sql_result)
+        context_str = _context_to_prompt(context)
         
         prompt = f"""
         You are an expert data analyst providing answers based on SQL query results.
@@ -296,18 +667,13 @@ class OpenRouterProvider(LLMProvider):
         {result_str}
         
         CONTEXT:
-        {json.dumps(context, indent=2)}
+        {context_str}
         
         Your task is to provide a clear, concise answer to the user's question based on the SQL query results.
         Explain the results in natural language, providing insights and context where appropriate.
         If the results are empty or don't directly answer the question, acknowledge this and explain possible reasons why.
         """
         
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
         data = {
             "model": self.model,
             "messages": [
@@ -317,8 +683,36 @@ class OpenRouterProvider(LLMProvider):
             "temperature": 0.3
         }
         
-        response = requests.post(self.api_url, headers=headers, json=data)
+        if stream_to is not None:
+            data["stream"] = True
+            with self.session.post(self.api_url, json=data, timeout=60, stream=True) as response:
+                response.raise_for_status()
+                return _collect_stream(self._iter_stream_content(response), stream_to)
+        
+        response = self.session.post(self.api_url, json=data, timeout=60)
         response.raise_for_status()
         result = response.json()
         
         return result["choices"][0]["message"]["content"].strip()
+    
+    def _iter_stream_content(self, response):
+        """
+        Parse the server-sent events of a streamed OpenRouter completion.
+        
+        Args:
+            response (requests.Response): Streaming response from the API
+            
+        Yields:
+            str: Content of each streamed delta
+        """
+        # SSE is UTF-8, but requests assumes ISO-8859-1 for text/* without a charset
+        response.encoding = "utf-8"
+        for line in response.iter_lines(decode_unicode=True):
+            # Skip blank separators and keep-alive comments such as ": OPENROUTER PROCESSING"
+            if not line or not line.startswith("data: "):
+                continue
+            payload = line[len("data: "):]
+            if payload == "[DONE]":
+                break
+            choices = json.loads(payload).get("choices") or [{}]
+            yield choices[0].get("delta", {}).get("content")
@@ -1,103 +1,504 @@
+import asyncio
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
+try:
+    # Used to repair common SQL mistakes locally before asking the LLM
+    import sqlglot
+    from sqlglot import exp
+except ImportError:
+    sqlglot = None
+
+# Maximum number of answers kept in the per-system answer cache
+ANSWER_CACHE_SIZE = 256
+
+# Markdown code fences around a SQL query, e.g. ```sql ... ```
+_FENCE_PATTERN = re.compile(r'^```(?:sql)?\s*|\s*```$', re.IGNORECASE)
+
+# Runs of whitespace/underscores, which are treated as equivalent when repairing names
+_SEPARATOR_PATTERN = re.compile(r'[\s_]+')
+
+# Maximum number of result rows loaded for the LLM; larger results are only counted
+RESULT_ROW_LIMIT = 1000
+
 class RAGSystem:
     """
     Retrieval-Augmented Generation (RAG) system for querying Excel data using natural language.
     """
     
-    def __init__(self, database, llm_provider):
+    def __init__(self, database, llm_provider=None):
         """
         Initialize the RAG system.
         
         Args:
             database (ExcelDatabase): Database instance
-            llm_provider (LLMProvider): LLM provider instance
+            llm_provider (LLMProvider, optional): LLM provider instance; may be
+                assigned later, before the first query
         """
         self.database = database
         self.llm_provider = llm_provider
+        # Maps a hashed (query, schema, provider, model) key to (sql_query, response)
+        self._answer_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # How many failed queries were repaired locally versus by another LLM call
+        self.fix_counts = {'local': 0, 'llm': 0}
+        # query_batch repairs queries on several threads at once
+        self._fix_lock = threading.Lock()
+        # Build the schema in the background so it is ready by the first question
+        executor = ThreadPoolExecutor(max_workers=1)
+        self._schema_future = executor.submit(self.database.get_schema_json)
+        # Nothing else is submitted, so let the worker exit once the schema is built
+        executor.shutdown(wait=False)
     
-    def query(self, natural_language_query):
+    def query(self, natural_language_query, stream_to=None):
         """
         Process a natural language query using the RAG system.
         
         Args:
             natural_language_query (str): Natural language query from the user
+            stream_to (callable, optional): Called with each chunk of the response
+                as it is generated; not called when the answer comes from the cache
             
         Returns:
             tuple: (sql_query, response) where sql_query is the generated SQL and
                   response is the natural language answer
         """
-        # Get database schema information to help the LLM understand the data
-        database_schema = self._get_database_schema()
+        # Wait for the background schema build started in __init__
+        self._schema_future.result()
         
-        # Generate SQL query from natural language
-        sql_query = self.llm_provider.generate_sql(natural_language_query, database_schema)
+        # Identical questions against the same data and model reuse the earlier answer
+        cache_key = self._answer_cache_key(natural_language_query)
+        cached_answer = self._get_cached_answer(cache_key)
+        if cached_answer is not None:
+            return cached_answer
         
-        # Clean the SQL query (remove markdown code blocks if present)
-        sql_query = self._clean_sql_query(sql_query)
+        # Get database schema information to help the LLM understand the data,
+        # in its cached JSON form so providers don't re-serialize it per call
+        schema_str = self.database.get_schema_json()
         
-        # Execute the SQL query
+        if self.llm_provider.supports_tools:
+            # Let the model run the SQL itself within a single conversation
+            sql_query, response, has_data = self._answer_with_tools(
+                natural_language_query, schema_str, stream_to
+            )
+        else:
+            sql_query, response = self._answer_with_sql(
+                natural_language_query, schema_str, stream_to
+            )
+            has_data = True
+        
+        # Only successful answers are cached, so failures are retried next time
+        if has_data:
+            self._cache_answer(cache_key, (sql_query, response))
+        
+        return sql_query, response
+    
+    async def query_batch(self, questions, max_concurrency=8, rpm=100, on_progress=None):
+        """
+        Process several natural language queries concurrently.
+        
+        Each question runs through query() on a worker thread. A semaphore bounds
+        how many run at once and their starts are spaced out to stay under the
+        provider's rate limit.
+        
+        Args:
+            questions (list): Natural language queries
+            max_concurrency (int): Maximum number of questions in flight at once
+            rpm (int): Maximum number of questions started per minute
+            on_progress (callable, optional): Called as on_progress(completed, total,
+                index, result) each time a question finishes
+            
+        Returns:
+            list: For each question, in order, its (sql_query, response) tuple or
+                  the exception raised while answering it
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        loop = asyncio.get_running_loop()
+        interval = 60 / rpm
+        next_start = loop.time()
+        results = [None] * len(questions)
+        completed = 0
+        
+        async def answer(index, question):
+            nonlocal next_start, completed
+            async with semaphore:
+                # Reserve the next start slot, then wait for it
+                start = max(loop.time(), next_start)
+                next_start = start + interval
+                await asyncio.sleep(start - loop.time())
+                
+                try:
+                    results[index] = await asyncio.to_thread(self.query, question)
+                except Exception as e:
+                    # Keep going so one failure doesn't lose the other answers
+                    results[index] = e
+            
+            completed += 1
+            if on_progress is not None:
+                on_progress(completed, len(questions), index, results[index])
+        
+        await asyncio.gather(*(answer(index, question) for index, question in enumerate(questions)))
+        return results
+    
+    def query_marshaled(self, questions, batch_size=4):
+        """
+        Process several natural language queries with shared LLM calls.
+        
+        Questions are packed into batches so each batch needs one SQL generation
+        call and one response generation call, instead of two calls per question.
+        Questions that are already in the answer cache are not sent again.
+        
+        Args:
+            questions (list): Natural language queries
+            batch_size (int): Number of questions packed into each prompt
+            
+        Returns:
+            list: For each question, in order, its (sql_query, response) tuple or
+                  the exception raised while answering it
+        """
+        # Wait for the background schema build started in __init__
+        self._schema_future.result()
+        
+        answers = [None] * len(questions)
+        cache_keys = [self._answer_cache_key(question) for question in questions]
+        pending = []
+        for index, cache_key in enumerate(cache_keys):
+            answers[index] = self._get_cached_answer(cache_key)
+            if answers[index] is None:
+                pending.append(index)
+        
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            try:
+                batch_answers = self._answer_marshaled([questions[index] for index in batch])
+            except Exception as e:
+                # Keep going so one failed batch doesn't lose the other answers
+                batch_answers = [e] * len(batch)
+            for index, answer in zip(batch, batch_answers):
+                answers[index] = answer
+                if not isinstance(answer, Exception):
+                    self._cache_answer(cache_keys[index], answer)
+        
+        return answers
+    
+    def _answer_marshaled(self, questions):
+        """
+        Answer a batch of queries with one SQL generation and one response call.
+        
+        Args:
+            questions (list): Natural language queries
+            
+        Returns:
+            list: For each question, in order, its (sql_query, response) tuple or
+                  the exception raised while running its SQL query
+        """
+        schema_str = self.database.get_schema_json()
+        
+        # Generate all SQL queries at once, then run them locally
+        sql_queries = self.llm_provider.generate_sql_batch(questions, schema_str)
+        answers = [None] * len(questions)
+        executed = {}
+        for index, sql_query in enumerate(sql_queries):
+            try:
+                executed[index] = self._execute_with_fix(self._clean_sql_query(sql_query), schema_str)
+            except Exception as e:
+                # Report the failure for this question only
+                answers[index] = e
+        
+        if not executed:
+            return answers
+        
+        # Marshal every answerable question and its results into a single response call
+        indices = list(executed)
+        contexts = [
+            {
+                'original_query': questions[index],
+                'sql_query': executed[index][0],
+                'schema': schema_str
+            }
+            for index in indices
+        ]
+        responses = self.llm_provider.generate_response_batch(
+            [questions[index] for index in indices],
+            [executed[index][1] for index in indices],
+            contexts
+        )
+        
+        for index, response in zip(indices, responses):
+            answers[index] = (executed[index][0], response)
+        return answers
+    
+    def _execute_with_fix(self, sql_query, schema_str):
+        """
+        Execute a SQL query, asking the LLM to fix it once if it fails.
+        
+        Args:
+            sql_query (str): Cleaned SQL query
+            schema_str (str): JSON serialization of the schema
+            
+        Returns:
+            tuple: (sql_query, results) with the query that actually ran
+        """
         try:
-            results = self.database.execute_query(sql_query)
+            sql_query, results = self._execute_with_local_fix(sql_query)
         except Exception as e:
-            # If there's an error, try to fix the SQL query
-            fixed_sql = self._fix_sql_query(sql_query, str(e), database_schema)
+            # If the local repair didn't help, ask the LLM to fix the SQL query
+            with self._fix_lock:
+                self.fix_counts['llm'] += 1
+            fixed_sql = self._fix_sql_query(sql_query, str(e), schema_str)
             # Clean the fixed SQL query as well
             fixed_sql = self._clean_sql_query(fixed_sql)
-            results = self.database.execute_query(fixed_sql)
+            results = self.database.execute_query(fixed_sql, max_rows=RESULT_ROW_LIMIT)
             sql_query = fixed_sql  # Update the SQL query to the fixed version
         
+        return sql_query, results
+    
+    def _execute_with_local_fix(self, sql_query):
+        """
+        Execute a SQL query, retrying once with a locally repaired version if it fails.
+        
+        Args:
+            sql_query (str): Cleaned SQL query
+            
+        Returns:
+            tuple: (sql_query, results) with the query that actually ran
+            
+        Raises:
+            Exception: The original error if the query can't be repaired locally
+        """
+        try:
+            return sql_query, self.database.execute_query(sql_query, max_rows=RESULT_ROW_LIMIT)
+        except Exception as error:
+            local_sql = self._local_fix_sql(sql_query)
+            if local_sql is not None:
+                try:
+                    results = self.database.execute_query(local_sql, max_rows=RESULT_ROW_LIMIT)
+                except Exception:
+                    pass
+                else:
+                    with self._fix_lock:
+                        self.fix_counts['local'] += 1
+                    return local_sql, results
+            raise error
+    
+    def _local_fix_sql(self, sql_query):
+        """
+        Repair table and column names in a SQL query without calling the LLM.
+        
+        Identifiers that don't exist in the schema are mapped to the table or
+        column whose name matches once case, spaces and underscores are
+        ignored. Anything else is left for the LLM to fix.
+        
+        Args:
+            sql_query (str): SQL query that failed to execute
+            
+        Returns:
+            str or None: Repaired SQL query, or None if no repair was possible
+        """
+        if sqlglot is None:
+            return None
+        
+        try:
+            tree = sqlglot.parse_one(sql_query, read='sqlite')
+        except sqlglot.errors.SqlglotError:
+            return None
+        
+        columns_by_table = {
+            info['table_name']: [str(column['name']) for column in info['columns']]
+            for info in self._get_database_schema().values()
+        }
+        
+        # Names the query defines itself must not be mapped onto the schema
+        aliases = {alias.alias.lower() for alias in tree.find_all(exp.Alias)}
+        cte_names = {cte.alias.lower() for cte in tree.find_all(exp.CTE)}
+        
+        changed = False
+        used_tables = set()
+        for table in tree.find_all(exp.Table):
+            if table.name.lower() in cte_names:
+                continue
+            remapped = self._replace_identifier(table, list(columns_by_table))
+            if remapped is None:
+                # A name we can't resolve would be misread (e.g. as a string literal)
+                return None
+            changed = changed or remapped
+            used_tables.add(table.name.lower())
+        
+        # Only columns of the tables the query reads from are valid, each name once
+        column_names = {}
+        for table_name, columns in columns_by_table.items():
+            if table_name.lower() in used_tables:
+                for column in columns:
+                    column_names.setdefault(column.lower(), column)
+        
+        for column in tree.find_all(exp.Column):
+            if isinstance(column.this, exp.Star) or column.name.lower() in aliases:
+                continue
+            remapped = self._replace_identifier(column, list(column_names.values()))
+            if remapped is None:
+                return None
+            changed = changed or remapped
+        
+        return tree.sql(dialect='sqlite') if changed else None
+    
+    def _replace_identifier(self, node, candidates):
+        """
+        Point a table or column node at the schema name it refers to.
+        
+        Args:
+            node (sqlglot.exp.Expression): Table or Column node to update in place
+            candidates (list): Valid names for the node
+            
+        Returns:
+            bool or None: True if the node was remapped, False if it was already
+            valid, or None if it doesn't match any candidate
+        """
+        name = node.name
+        if name.lower() in {candidate.lower() for candidate in candidates}:
+            return False
+        
+        by_normalized = {}
+        for candidate in candidates:
+            by_normalized.setdefault(self._normalize_identifier(candidate), []).append(candidate)
+        matches = by_normalized.get(self._normalize_identifier(name), [])
+        if len(matches) != 1:
+            return None
+        
+        node.set('this', exp.to_identifier(matches[0], quoted=True))
+        return True
+    
+    @staticmethod
+    def _normalize_identifier(name):
+        """Lowercase a name and collapse spaces and underscores for matching."""
+        return _SEPARATOR_PATTERN.sub('_', name.strip().lower())
+    
+    def _get_cached_answer(self, cache_key):
+        """
+        Look up a previous answer, marking it as recently used.
+        
+        Args:
+            cache_key (str): Key from _answer_cache_key
+            
+        Returns:
+            tuple or None: (sql_query, response), or None if not cached
+        """
+        with self._cache_lock:
+            if cache_key not in self._answer_cache:
+                return None
+            self._answer_cache.move_to_end(cache_key)
+            return self._answer_cache[cache_key]
+    
+    def _cache_answer(self, cache_key, answer):
+        """
+        Store an answer, evicting the least recently used one when full.
+        
+        Args:
+            cache_key (str): Key from _answer_cache_key
+            answer (tuple): (sql_query, response)
+        """
+        with self._cache_lock:
+            self._answer_cache[cache_key] = answer
+            if len(self._answer_cache) > ANSWER_CACHE_SIZE:
+                self._answer_cache.popitem(last=False)
+    
+    def _answer_with_sql(self, natural_language_query, schema_str, stream_to=None):
+        """
+        Answer a query with separate SQL generation and response generation calls.
+        
+        Args:
+            natural_language_query (str): Natural language query from the user
+            schema_str (str): JSON serialization of the schema
+            stream_to (callable, optional): Called with each chunk of the response
+            
+        Returns:
+            tuple: (sql_query, response)
+        """
+        # Generate SQL query from natural language
+        sql_query = self.llm_provider.generate_sql(natural_language_query, schema_str)
+        
+        # Clean the SQL query (remove markdown code blocks if present)
+        sql_query = self._clean_sql_query(sql_query)
+        
+        # Execute the SQL query
+        sql_query, results = self._execute_with_fix(sql_query, schema_str)
+        
         # Generate a natural language response
         context = {
             'original_query': natural_language_query,
             'sql_query': sql_query,
-            'schema': database_schema
+            'schema': schema_str
         }
-        response = self.llm_provider.generate_response(natural_language_query, results, context)
+        response = self.llm_provider.generate_response(
+            natural_language_query, results, context, stream_to=stream_to
+        )
         
         return sql_query, response
     
+    def _answer_with_tools(self, natural_language_query, schema_str, stream_to=None):
+        """
+        Answer a query in one conversation where the model calls a SQL tool.
+        
+        Args:
+            natural_language_query (str): Natural language query from the user
+            schema_str (str): JSON serialization of the schema
+            stream_to (callable, optional): Called with each chunk of the response
+            
+        Returns:
+            tuple: (sql_query, response, has_data) where sql_query is the last SQL
+                  that ran successfully, or None if the model answered without data,
+                  and has_data is False if the model ran SQL but every query failed
+        """
+        attempts = 0
+        executed = []
+        
+        def run_sql(sql_query):
+            nonlocal attempts
+            attempts += 1
+            sql_query = self._clean_sql_query(sql_query)
+            sql_query, results = self._execute_with_local_fix(sql_query)
+            executed.append(sql_query)
+            return results
+        
+        response = self.llm_provider.answer_with_tools(
+            natural_language_query, schema_str, run_sql, stream_to=stream_to
+        )
+        sql_query = executed[-1] if executed else None
+        
+        return sql_query, response, bool(executed) or attempts == 0
+    
+    def _answer_cache_key(self, natural_language_query):
+        """
+        Build the answer cache key for a query.
+        
+        Args:
+            natural_language_query (str): Natural language query from the user
+            
+        Returns:
+            str: Hash of the normalized query, schema, provider and model
+        """
+        normalized_query = " ".join(natural_language_query.split())
+        parts = [
+            normalized_query,
+            self.database.get_schema_fingerprint(),
+            type(self.llm_provider).__name__,
+            str(getattr(self.llm_provider, 'model', '')),
+        ]
+        return hashlib.blake2b("\x00".join(parts).encode()).hexdigest()
+    
     def _get_database_schema(self):
         """
         Get the database schema information.
         
+        The schema is cached by the database, so this is cheap to call per query.
+        
         Returns:
             dict: Schema information about all tables in the database
         """
-        sheet_info = self.database.get_all_sheet_info()
-        schema = {}
-        
-        for sheet_name, info in sheet_info.items():
-            table_name = info['clean_name']
-            df = info['data']
-            
-            # Get column information
-            columns = []
-            for col in df.columns:
-                dtype_str = str(df[col].dtype)
-                # Map pandas dtypes to more understandable types
-                if 'int' in dtype_str:
-                    column_type = 'INTEGER'
-                elif 'float' in dtype_str:
-                    column_type = 'REAL'
-                elif 'datetime' in dtype_str:
-                    column_type = 'DATETIME'
-                else:
-                    column_type = 'TEXT'
-                
-                columns.append({
-                    'name': col,
-                    'type': column_type,
-                    'sample_values': df[col].dropna().sample(min(3, max(1, len(df)))).tolist()
-                })
-            
-            schema[sheet_name] = {
-                'table_name': table_name,
-                'columns': columns,
-                'row_count': len(df)
-            }
-        
-        return schema
+        return self.database.get_schema()
     
     def _fix_sql_query(self, sql_query, error_message, database_schema):
         """
@@ -106,7 +507,7 @@ class RAGSystem:
         Args:
             sql_query (str): Original SQL query
             error_message (str): Error message from the failed query
-            database_schema (dict): Schema information about the database
+            database_schema (dict or str): Schema information about the database
             
         Returns:
             str: Fixed SQL query
@@ -145,17 +546,5 @@ class RAGSystem:
         Returns:
             str: Cleaned SQL query
         """
-        # Remove markdown code block syntax if present
-        sql_query = sql_query.strip()
-        
-        # Remove ```sql at the beginning if present
-        if sql_query.startswith("```sql"):
-            sql_query = sql_query[6:].strip()
-        elif sql_query.startswith("```"):
-            sql_query = sql_query[3:].strip()
-            
-        # Remove ``` at the end if present
-        if sql_query.endswith("```"):
-            sql_query = sql_query[:-3].strip()
-            
-        return sql_query
+        # Remove markdown code block syntax at either end if present
+        return _FENCE_PATTERN.sub('', sql_query.strip()).strip()